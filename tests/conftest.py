@@ -0,0 +1,23 @@
+import os
+import sys
+import types
+
+# webapp.py y timelapse.py están en la raíz del repositorio, no en un paquete
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# picamera2 solo existe en la Raspberry Pi; las pruebas no tocan la cámara, así que
+# basta con módulos vacíos para poder importar webapp y timelapse
+try:
+    import picamera2  # noqa: F401
+except ImportError:
+    _stubs = {
+        "picamera2": ("Picamera2", "MappedArray"),
+        "picamera2.allocators": ("PersistentAllocator",),
+        "picamera2.encoders": ("JpegEncoder",),
+        "picamera2.outputs": ("FileOutput",),
+    }
+    for _name, _attrs in _stubs.items():
+        _module = types.ModuleType(_name)
+        for _attr in _attrs:
+            setattr(_module, _attr, None)
+        sys.modules[_name] = _module
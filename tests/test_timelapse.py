@@ -0,0 +1,58 @@
+import datetime
+
+import pytest
+
+orjson = pytest.importorskip("orjson")
+
+from timelapse import TimeLapse
+
+# 2024-01-01 fue lunes (weekday() == 0)
+MONDAY = datetime.date(2024, 1, 1)
+TUESDAY = datetime.date(2024, 1, 2)
+
+
+def make_timelapse(tmp_path, start_time, end_time, active_days=(0, 1, 2, 3, 4, 5, 6)):
+    config_path = tmp_path / "config.json"
+    config_path.write_bytes(orjson.dumps({
+        "start_time": start_time,
+        "end_time": end_time,
+        "active_days": list(active_days),
+        "interval_seconds": 60,
+        "base_folder": str(tmp_path / "timelapse_images"),
+        "resolution": {"width": 1920, "height": 1080},
+    }))
+    return TimeLapse(config_file=str(config_path))
+
+
+def at(day, hour, minute):
+    return datetime.datetime.combine(day, datetime.time(hour, minute))
+
+
+def test_daytime_window(tmp_path):
+    timelapse = make_timelapse(tmp_path, "08:00", "18:00")
+
+    assert not timelapse.is_time_to_capture(at(MONDAY, 7, 59))
+    assert timelapse.is_time_to_capture(at(MONDAY, 8, 0))
+    assert timelapse.is_time_to_capture(at(MONDAY, 12, 30))
+    assert timelapse.is_time_to_capture(at(MONDAY, 18, 0))
+    assert not timelapse.is_time_to_capture(at(MONDAY, 18, 1))
+    assert not timelapse.is_time_to_capture(at(MONDAY, 0, 0))
+
+
+def test_window_wrapping_midnight(tmp_path):
+    timelapse = make_timelapse(tmp_path, "22:00", "06:00")
+
+    assert not timelapse.is_time_to_capture(at(MONDAY, 21, 59))
+    assert timelapse.is_time_to_capture(at(MONDAY, 22, 0))
+    assert timelapse.is_time_to_capture(at(MONDAY, 23, 59))
+    assert timelapse.is_time_to_capture(at(TUESDAY, 0, 0))
+    assert timelapse.is_time_to_capture(at(TUESDAY, 6, 0))
+    assert not timelapse.is_time_to_capture(at(TUESDAY, 6, 1))
+    assert not timelapse.is_time_to_capture(at(TUESDAY, 12, 0))
+
+
+def test_inactive_day(tmp_path):
+    timelapse = make_timelapse(tmp_path, "08:00", "18:00", active_days=(1, 2, 3, 4, 5, 6))
+
+    assert not timelapse.is_time_to_capture(at(MONDAY, 12, 0))
+    assert timelapse.is_time_to_capture(at(TUESDAY, 12, 0))
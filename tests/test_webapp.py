@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip("flask")
+orjson = pytest.importorskip("orjson")
+
+import webapp
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    base_folder = tmp_path / "timelapse_images"
+    (base_folder / "2024-01-01").mkdir(parents=True)
+    (base_folder / "2024-01-01" / "TL_20240101_120000_001.jpg").write_bytes(b"\xff\xd8fake-jpeg\xff\xd9")
+    config_path = tmp_path / "config.json"
+    config_path.write_bytes(orjson.dumps({"base_folder": str(base_folder)}))
+    monkeypatch.setattr(webapp, "config_file", str(config_path))
+    return webapp.app.test_client()
+
+
+def test_get_image_sends_etag_and_answers_304(client):
+    url = "/images/2024-01-01/TL_20240101_120000_001.jpg"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers.get("ETag")
+    assert etag
+    assert "immutable" in response.headers["Cache-Control"]
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def expected_tail(path, n):
+    with open(path, 'rb') as f:
+        return [line.decode('utf-8') for line in f.readlines()[-n:]]
+
+
+def test_tail_lines_file_smaller_than_block(tmp_path):
+    path = tmp_path / "small.log"
+    path.write_bytes(b"uno\ndos\ntres\n")
+
+    assert webapp.tail_lines(str(path), 2) == expected_tail(path, 2)
+
+
+def test_tail_lines_line_crossing_block_boundary(tmp_path):
+    path = tmp_path / "boundary.log"
+    # La última línea empieza antes del último bloque y termina dentro de él
+    last_line = b"x" * (webapp.LOG_TAIL_BLOCK + 100) + b"\n"
+    path.write_bytes(b"".join(b"linea %d\n" % i for i in range(2000)) + last_line)
+
+    for n in (1, 2, 50):
+        assert webapp.tail_lines(str(path), n) == expected_tail(path, n)
+
+
+def test_tail_lines_without_trailing_newline(tmp_path):
+    path = tmp_path / "no_newline.log"
+    path.write_bytes(b"".join(b"linea %d\n" % i for i in range(3000)) + b"final sin salto")
+
+    for n in (1, 3):
+        assert webapp.tail_lines(str(path), n) == expected_tail(path, n)
+
+
+def test_tail_lines_more_lines_than_file(tmp_path):
+    path = tmp_path / "short.log"
+    path.write_bytes(b"uno\ndos\n")
+
+    assert webapp.tail_lines(str(path), 50) == expected_tail(path, 50)
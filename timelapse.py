@@ -2,39 +2,170 @@
 import os
 import time
 import datetime
-import json
 import argparse
 import logging
+import logging.handlers
+import queue
+import signal
+import tempfile
+import threading
 import traceback
-from picamera2 import Picamera2
-
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("timelapse.log"),
-        logging.StreamHandler()
-    ]
-)
+import numpy as np
+import orjson
+import simplejpeg
+from picamera2 import Picamera2, MappedArray
+from picamera2.allocators import PersistentAllocator
+
+# Logger propio (y no el raíz) para que, al importar este módulo desde la webapp,
+# sus mensajes sigan yendo a timelapse.log. Los handlers los añade setup_logging()
 logger = logging.getLogger("TimeLapse")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+# Los archivos de log rotan al llegar a LOG_MAX_BYTES para no crecer sin límite en
+# la tarjeta SD; la webapp usa los mismos valores para webapp.log
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+def setup_logging():
+    """Añade al logger del time-lapse la salida a timelapse.log y a la consola
+
+    Se llama al arrancar (main o la webapp) y no al importar el módulo, para que
+    solo el proceso que va a ejecutar el time-lapse abra y rote timelapse.log.
+    Las llamadas repetidas no hacen nada.
+    """
+    if logger.handlers:
+        return
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = logging.handlers.RotatingFileHandler("timelapse.log", maxBytes=LOG_MAX_BYTES,
+                                                        backupCount=LOG_BACKUP_COUNT)
+    for handler in (file_handler, logging.StreamHandler()):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+# Imágenes pendientes de codificar y escribir en disco como máximo. Se
+# reserva un array reutilizable por cada una; a 9152x6944 cada array ocupa
+# ~190 MB, así que la cola es corta.
+WRITE_QUEUE_SIZE = 2
+# Misma calidad que usa picamera2 por defecto en capture_file
+JPEG_QUALITY = 90
+# Tiempo máximo de espera a que converja la exposición automática al arrancar
+CAMERA_SETTLE_TIMEOUT = 2.0
+
+def _write_fd(fd, data):
+    """Escribe todos los bytes en el descriptor y los sincroniza al disco"""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+    os.fsync(fd)
+
+def write_file_atomic(filename, data):
+    """Escribe los bytes en un temporal único de la misma carpeta y lo renombra al nombre final
+
+    Cada escritura usa su propio temporal, así que dos escrituras simultáneas del
+    mismo archivo no se pisan y nadie llega a ver el archivo a medias.
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                        prefix="." + os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        try:
+            # mkstemp crea el archivo con permisos 0600
+            os.fchmod(fd, 0o644)
+            _write_fd(fd, data)
+        finally:
+            os.close(fd)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+def write_json_atomic(filename, data):
+    """Guarda el JSON compacto en un archivo temporal y lo renombra, para que nunca quede a medias"""
+    write_file_atomic(filename, orjson.dumps(data))
+
+def wait_for_camera_ready(camera, timeout=CAMERA_SETTLE_TIMEOUT):
+    """Espera al primer frame y a que converjan la exposición y el balance de blancos automáticos
+
+    Nunca supera el timeout. Si la cámara no informa de AeLocked ni de AwbLocked
+    no hay forma de saber cuándo ha convergido, así que se espera el timeout completo.
+    """
+    deadline = time.monotonic() + timeout
+    # El primer frame entregado indica que la cámara está realmente en marcha
+    metadata = camera.capture_metadata()
+    lock_keys = [key for key in ("AeLocked", "AwbLocked") if key in metadata]
+    if not lock_keys:
+        time.sleep(max(0.0, deadline - time.monotonic()))
+        return
+    while not all(metadata.get(key, True) for key in lock_keys) and time.monotonic() < deadline:
+        metadata = camera.capture_metadata()
+
+def format_capture_time(now):
+    """Devuelve (carpeta del día "YYYY-MM-DD", marca "YYYYMMDD_HHMMSS") sin pasar por strftime"""
+    date_folder = f"{now.year:04d}-{now.month:02d}-{now.day:02d}"
+    timestamp = f"{now.year:04d}{now.month:02d}{now.day:02d}_{now.hour:02d}{now.minute:02d}{now.second:02d}"
+    return date_folder, timestamp
+
+def parse_time_minutes(value):
+    """Convierte una hora "HH:MM" en minutos desde la medianoche"""
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
 
 class TimeLapse:
     def __init__(self, config_file="config.json"):
         """Inicializa la aplicación de TimeLapse"""
         self.config_file = config_file
+        self._config_stamp = None
         self.config = self.load_config()
+        self._compile_schedule()
         self.camera = None
-        
+        self._stop = threading.Event()
+        self._created_dirs = set()
+        self._image_counts = {}
+        self._write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._free_frames = queue.Queue()
+        self._writer_thread = None
+
+    def stop(self):
+        """Solicita la detención del bucle principal"""
+        self._stop.set()
+
+    def _handle_signal(self, signum, frame):
+        """Convierte SIGINT/SIGTERM en una petición de parada ordenada"""
+        logger.info(f"Señal {signum} recibida, deteniendo time-lapse")
+        self.stop()
+
+    def _get_config_stamp(self):
+        """Devuelve (mtime, tamaño) del archivo de configuración o None si no existe"""
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read_config_file(self):
+        """Lee y parsea el archivo de configuración; devuelve None si no es posible"""
+        stamp = self._get_config_stamp()
+        if stamp is None:
+            return None
+        # Se recuerda la marca aunque falle el parseo para no reintentar en cada ciclo
+        self._config_stamp = stamp
+        try:
+            with open(self.config_file, 'rb') as f:
+                return orjson.loads(f.read())
+        except Exception as e:
+            logger.error(f"Error al cargar configuración: {e}")
+            return None
+
     def load_config(self):
         """Carga la configuración desde el archivo JSON"""
-        if os.path.exists(self.config_file):
-            try:
-                with open(self.config_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.error(f"Error al cargar configuración: {e}")
-                
+        config = self._read_config_file()
+        if config is not None:
+            return config
+
         # Configuración por defecto
         return {
             "start_time": "08:00",
@@ -47,12 +178,39 @@ class TimeLapse:
                 "height": 1080
             }
         }
-    
+
+    def refresh_config(self):
+        """Recarga la configuración solo si el archivo ha cambiado en disco"""
+        stamp = self._get_config_stamp()
+        if stamp is None or stamp == self._config_stamp:
+            return False
+        config = self._read_config_file()
+        if config is None:
+            return False
+        self.config = config
+        self._compile_schedule()
+        logger.info("Configuración recargada desde disco")
+        return True
+
+    def _compile_schedule(self):
+        """Precalcula la ventana horaria y los días activos en formatos de comparación rápida"""
+        try:
+            self._start_min = parse_time_minutes(self.config["start_time"])
+            self._end_min = parse_time_minutes(self.config["end_time"])
+        except (KeyError, ValueError) as e:
+            logger.error(f"Horario no válido en la configuración: {e}. Se usará el día completo")
+            self._start_min = 0
+            self._end_min = 24 * 60 - 1
+        # Una ventana como 22:00-06:00 cruza la medianoche
+        self._wraps = self._start_min > self._end_min
+        self._active_days = frozenset(self.config.get("active_days", ()))
+
     def save_config(self):
         """Guarda la configuración actual en el archivo JSON"""
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=4)
+            write_json_atomic(self.config_file, self.config)
+            self._config_stamp = self._get_config_stamp()
+            self._compile_schedule()
             logger.info("Configuración guardada correctamente")
         except Exception as e:
             logger.error(f"Error al guardar configuración: {e}")
@@ -61,7 +219,9 @@ class TimeLapse:
         """Inicializa la cámara con la configuración adecuada"""
         try:
             logger.info("Inicializando cámara para time-lapse...")
-            self.camera = Picamera2()
+            # Los buffers DMA se reservan una vez y se reutilizan, evitando
+            # fragmentar el heap CMA en ejecuciones largas
+            self.camera = Picamera2(allocator=PersistentAllocator())
             
             # Configurar resolución
             width = self.config["resolution"]["width"]
@@ -71,19 +231,23 @@ class TimeLapse:
             # Usar una configuración más compatible y estable
             try:
                 config = self.camera.create_still_configuration(
-                    main={"size": (width, height)}
+                    main={"size": (width, height), "format": "BGR888"},
+                    buffer_count=1
                 )
                 self.camera.configure(config)
             except Exception as e:
                 logger.error(f"Error al configurar resolución {width}x{height}: {e}")
                 logger.info("Intentando con resolución predeterminada (1920x1080)")
                 config = self.camera.create_still_configuration(
-                    main={"size": (1920, 1080)}
+                    main={"size": (1920, 1080), "format": "BGR888"},
+                    buffer_count=1
                 )
                 self.camera.configure(config)
                 
+            self._allocate_frames()
             self.camera.start()
-            time.sleep(2)  # Dar tiempo a que la cámara se inicialice
+            wait_for_camera_ready(self.camera)
+            self._start_writer()
             logger.info("Cámara inicializada correctamente")
             return True
         except Exception as e:
@@ -91,83 +255,156 @@ class TimeLapse:
             logger.error(traceback.format_exc())
             return False
     
-    def is_time_to_capture(self):
+    def is_time_to_capture(self, now=None):
         """Verifica si es el momento adecuado para capturar según la configuración"""
-        now = datetime.datetime.now()
+        if now is None:
+            now = datetime.datetime.now()
         
         # Verificar día de la semana (0 = lunes, 6 = domingo en nuestra configuración)
-        weekday = now.weekday()
-        if weekday not in self.config["active_days"]:
+        if now.weekday() not in self._active_days:
             return False
         
-        # Verificar hora del día
-        current_time = now.strftime("%H:%M")
-        if current_time < self.config["start_time"] or current_time > self.config["end_time"]:
+        # Verificar hora del día en minutos desde la medianoche
+        current_min = now.hour * 60 + now.minute
+        if self._wraps:
+            return current_min >= self._start_min or current_min <= self._end_min
+        return self._start_min <= current_min <= self._end_min
+    
+    def _ensure_dir(self, path):
+        """Crea la carpeta si hace falta, recordando las ya creadas para no repetir la comprobación"""
+        if path in self._created_dirs:
+            return True
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as e:
+            logger.error(f"Error al crear la carpeta {path}: {e}")
             return False
-            
+        self._created_dirs.add(path)
         return True
-    
-    def capture_image(self):
+
+    def capture_image(self, now=None):
         """Captura una imagen y la guarda en la carpeta correspondiente"""
         if not self.camera:
             if not self.initialize_camera():
                 return False
         
-        now = datetime.datetime.now()
-        date_folder = now.strftime("%Y-%m-%d")
-        timestamp = now.strftime("%Y%m%d_%H%M%S")
-        
-        # Crear carpeta base si no existe
-        if not os.path.exists(self.config["base_folder"]):
-            try:
-                os.makedirs(self.config["base_folder"])
-                logger.info(f"Creada carpeta base: {self.config['base_folder']}")
-            except Exception as e:
-                logger.error(f"Error al crear carpeta base: {e}")
-                return False
+        if now is None:
+            now = datetime.datetime.now()
+        date_folder, timestamp = format_capture_time(now)
         
-        # Crear carpeta para el día actual si no existe
+        # Crear carpeta del día (y la carpeta base) si no existen
         day_folder = os.path.join(self.config["base_folder"], date_folder)
-        if not os.path.exists(day_folder):
-            try:
-                os.makedirs(day_folder)
-                logger.info(f"Creada carpeta del día: {day_folder}")
-            except Exception as e:
-                logger.error(f"Error al crear carpeta del día: {e}")
-                return False
+        if not self._ensure_dir(day_folder):
+            return False
         
-        # Obtener el número de imágenes actuales en la carpeta para el contador secuencial
+        # Array reutilizable donde copiar el frame; si no hay ninguno libre es
+        # que la escritura en disco va atrasada y se descarta esta captura
         try:
-            existing_images = [f for f in os.listdir(day_folder) if f.startswith('TL_')]
-            image_count = len(existing_images) + 1
-        except Exception as e:
-            logger.error(f"Error al contar imágenes existentes: {e}")
-            image_count = 1
+            frame = self._free_frames.get_nowait()
+        except queue.Empty:
+            logger.error("Escritura de imágenes atrasada, se descarta la captura")
+            return False
         
         # Nombre del archivo con formato TL_YYYYMMDD_HHMMSS_001.jpg
+        image_count = self._next_image_number(day_folder)
         filename = os.path.join(day_folder, f"TL_{timestamp}_{image_count:03d}.jpg")
-        
+        logger.debug("Capturando imagen: %s", filename)
+
+        # Copiar el frame y liberar el buffer de la cámara cuanto antes; la
+        # codificación JPEG y la escritura se hacen en el hilo escritor
         try:
-            logger.info(f"Capturando imagen: {filename}")
-            
-            # Capturar con método más simple
-            self.camera.capture_file(filename)
-            
-            # Verificar que el archivo existe y tiene tamaño
-            if os.path.exists(filename) and os.path.getsize(filename) > 0:
-                logger.info(f"Imagen capturada correctamente: {filename} ({os.path.getsize(filename)} bytes)")
-                return True
-            else:
-                logger.error(f"Imagen no guardada o tamaño cero: {filename}")
-                return False
+            request = self.camera.capture_request()
+            try:
+                with MappedArray(request, "main") as m:
+                    np.copyto(frame, m.array)
+            finally:
+                request.release()
         except Exception as e:
+            self._free_frames.put(frame)
             logger.error(f"Error al capturar imagen: {e}")
             logger.error(traceback.format_exc())
             return False
+
+        # Nunca hay más frames en uso que huecos en la cola, así que no bloquea
+        self._write_queue.put((filename, frame))
+        return True
+
+    def _next_image_number(self, day_folder):
+        """Devuelve el siguiente número secuencial para la carpeta del día
+
+        Se cuenta el contenido de la carpeta solo la primera vez, ya que las
+        imágenes aún en la cola de escritura no aparecen todavía en disco.
+        """
+        count = self._image_counts.get(day_folder)
+        if count is None:
+            try:
+                count = len([f for f in os.listdir(day_folder) if f.startswith('TL_')])
+            except Exception as e:
+                logger.error(f"Error al contar imágenes existentes: {e}")
+                count = 0
+        count += 1
+        self._image_counts[day_folder] = count
+        return count
+
+    def _allocate_frames(self):
+        """Reserva los arrays donde se copian los frames capturados, una sola vez"""
+        width, height = self.camera.camera_config["main"]["size"]
+        self._free_frames = queue.Queue()
+        for _ in range(WRITE_QUEUE_SIZE):
+            self._free_frames.put(np.empty((height, width, 3), dtype=np.uint8))
+
+    def _start_writer(self):
+        """Arranca el hilo que codifica y guarda las imágenes capturadas"""
+        if self._writer_thread and self._writer_thread.is_alive():
+            return
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="TimeLapseWriter")
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def _stop_writer(self):
+        """Espera a que se escriban las imágenes pendientes y detiene el hilo escritor"""
+        if not self._writer_thread:
+            return
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        self._writer_thread = None
+
+    def _writer_loop(self):
+        """Codifica en JPEG y escribe en disco las imágenes de la cola"""
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            filename, frame = item
+            try:
+                # El formato BGR888 de picamera2 guarda los píxeles en orden R, G, B
+                try:
+                    jpeg = simplejpeg.encode_jpeg(frame, quality=JPEG_QUALITY, colorspace='RGB')
+                finally:
+                    self._free_frames.put(frame)
+                # Temporal + renombrado: la galería nunca sirve (ni cachea) un JPEG a medias
+                write_file_atomic(filename, jpeg)
+                
+                # Verificar que el archivo existe y tiene tamaño
+                size = os.path.getsize(filename)
+                if size > 0:
+                    logger.info(f"Imagen capturada correctamente: {filename} ({size} bytes)")
+                else:
+                    logger.error(f"Imagen no guardada o tamaño cero: {filename}")
+            except Exception as e:
+                logger.error(f"Error al guardar imagen {filename}: {e}")
+                logger.error(traceback.format_exc())
+                # La carpeta pudo haberse borrado externamente; volver a comprobarla
+                self._created_dirs.discard(os.path.dirname(filename))
     
     def run(self):
         """Ejecuta el proceso de time-lapse según la configuración"""
         logger.info("Iniciando aplicación TimeLapse")
+
+        # Los manejadores de señales solo pueden instalarse desde el hilo principal
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self._handle_signal)
+            signal.signal(signal.SIGTERM, self._handle_signal)
         
         try:
             if not self.initialize_camera():
@@ -190,34 +427,28 @@ class TimeLapse:
             # Controlar los tiempos para respetar estrictamente el intervalo configurado
             next_capture_time = time.time()
             
-            while True:
-                # Esperar hasta el próximo momento de captura
-                current_time = time.time()
-                if current_time < next_capture_time:
-                    # Aún no es tiempo de capturar, esperar un poco
-                    sleep_time = min(1.0, next_capture_time - current_time)
-                    time.sleep(sleep_time)
-                    continue
-                
-                # Es tiempo de capturar
-                if self.is_time_to_capture():
-                    logger.info("Capturando imagen programada...")
-                    capture_successful = self.capture_image()
+            # Una única espera interrumpible hasta la próxima captura
+            while not self._stop.wait(max(0.0, next_capture_time - time.time())):
+                # Es tiempo de capturar; aplicar antes los cambios de configuración
+                self.refresh_config()
+                # Una sola lectura del reloj por ciclo para el horario y el nombre del archivo
+                now = datetime.datetime.now()
+                if self.is_time_to_capture(now):
+                    logger.debug("Capturando imagen programada...")
+                    capture_successful = self.capture_image(now)
                     if capture_successful:
                         # Programar la próxima captura a exactamente el intervalo desde ahora
                         next_capture_time = time.time() + self.config["interval_seconds"]
-                        logger.info(f"Próxima captura programada en {self.config['interval_seconds']} segundos")
+                        logger.debug("Próxima captura programada en %s segundos", self.config["interval_seconds"])
                     else:
                         # Si falló, intentar nuevamente después de un breve retraso
                         next_capture_time = time.time() + 5
                         logger.info("Reintentando captura en 5 segundos debido a un error")
                 else:
-                    logger.info("No es momento de capturar según la configuración")
-                    # Comprobar nuevamente en un minuto
+                    # Fuera del horario configurado: comprobar nuevamente en un minuto
                     next_capture_time = time.time() + 60
-                
-                # Breve pausa para permitir interrupciones
-                time.sleep(0.1)
+
+            logger.info("Aplicación detenida por el usuario")
                 
         except KeyboardInterrupt:
             logger.info("Aplicación detenida por el usuario")
@@ -225,6 +456,7 @@ class TimeLapse:
             logger.error(f"Error no esperado: {e}")
             logger.error(traceback.format_exc())
         finally:
+            self._stop_writer()
             if self.camera:
                 try:
                     self.camera.stop()
@@ -237,6 +469,7 @@ def main():
     parser = argparse.ArgumentParser(description="Aplicación de TimeLapse para Raspberry Pi")
     parser.add_argument("--config", default="config.json", help="Ruta al archivo de configuración")
     args = parser.parse_args()
+    setup_logging()
     
     try:
         timelapse = TimeLapse(config_file=args.config)
@@ -1,47 +1,92 @@
 #!/usr/bin/env python3
 import os
-import json
-import subprocess
-import signal
+import atexit
+import argparse
 import logging
+import logging.handlers
+import queue
+import signal
+import sys
 import time
-import io
+import copy
 import threading
+import io
 import base64
-from flask import Flask, request, render_template, jsonify, send_from_directory, Response
+import hashlib
+import orjson
+from flask import Flask, request, render_template, send_from_directory, send_file, Response, abort
+from werkzeug.security import safe_join
+from PIL import Image
 from picamera2 import Picamera2
 from picamera2.encoders import JpegEncoder
 from picamera2.outputs import FileOutput
 import datetime
+from urllib.parse import quote
+from timelapse import (TimeLapse, write_json_atomic, write_file_atomic, format_capture_time, wait_for_camera_ready,
+                       setup_logging as setup_timelapse_logging, LOG_MAX_BYTES, LOG_BACKUP_COUNT)
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("webapp.log"),
-        logging.StreamHandler()
-    ]
+# Configurar logging. Los mensajes se encolan y un hilo aparte los escribe,
+# para que las peticiones y el streaming no esperen a la tarjeta SD.
+# La rotación usa los mismos límites que timelapse.log
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = (
+    logging.handlers.RotatingFileHandler("webapp.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT),
+    logging.StreamHandler(),
 )
+for _log_handler in _log_handlers:
+    _log_handler.setFormatter(_log_formatter)
+_log_queue = queue.Queue()
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# Solo el mensaje: el formato completo lo aplican los handlers del hilo de escritura
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
 logger = logging.getLogger("TimeLapseWeb")
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 config_file = "config.json"
-timelapse_process = None
+timelapse_runner = None
+timelapse_thread = None
 camera = None
-camera_lock = threading.Lock()
+camera_lock = threading.RLock()
+# Usuarios activos de la cámara de vista previa (hilo de vista previa, clientes MJPEG...);
+# la cámara solo se detiene cuando el último la libera
+camera_users = 0
 preview_active = False
 preview_thread = None
 stop_preview_event = threading.Event()
+# Se activa cuando preview_manager termina de arrancar (con o sin éxito)
+preview_ready = threading.Event()
 latest_preview_image = None
-timelapse_log_thread = None
-stop_log_thread = threading.Event()
 
 # Variables para el modo foto con intervalos
 photo_timelapse_active = False
 photo_timelapse_thread = None
 stop_photo_timelapse = threading.Event()
 
+# Caché de la configuración: se invalida cuando cambia el archivo en disco
+_config_cache = {"stamp": None, "data": None}
+_config_lock = threading.Lock()
+
+# Caché de listados de carpetas: ruta -> (mtime de la carpeta, listado)
+_listing_cache = {}
+_listing_lock = threading.Lock()
+
+# Carpetas de fotos ya creadas, para no repetir makedirs en cada captura
+_photo_folders = set()
+
+# Contador de fotos por (carpeta del día, prefijo): se inicializa contando la
+# carpeta una sola vez y después se incrementa en memoria
+_photo_counters = {}
+_photo_counters_lock = threading.Lock()
+
+# Conjunto fijo de candados para la generación de miniaturas: cada ruta usa siempre
+# el mismo, así que una miniatura nunca se genera dos veces a la vez
+THUMBNAIL_LOCK_COUNT = 16
+_thumbnail_locks = [threading.Lock() for _ in range(THUMBNAIL_LOCK_COUNT)]
+
 # Constantes para resoluciones predefinidas
 RESOLUTION_PRESETS = {
     "720p": {"width": 1280, "height": 720},
@@ -49,15 +94,90 @@ RESOLUTION_PRESETS = {
     "4K": {"width": 3840, "height": 2160},
     "max": {"width": 9152, "height": 6944}  # Máxima para Arducam 64MP
 }
+# Las resoluciones no cambian: se serializan una sola vez
+RESOLUTION_PRESETS_JSON = orjson.dumps(RESOLUTION_PRESETS)
+RESOLUTION_PRESETS_ETAG = hashlib.md5(RESOLUTION_PRESETS_JSON).hexdigest()
 
-def load_config():
-    """Carga la configuración desde el archivo JSON"""
-    if os.path.exists(config_file):
-        try:
-            with open(config_file, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Error al cargar configuración: {e}")
+# Página principal ya renderizada: (mtime de la plantilla, HTML)
+_index_cache = {"stamp": None, "body": None}
+
+# Las imágenes capturadas nunca cambian (el nombre incluye la marca de tiempo),
+# así que el navegador puede guardarlas en caché durante un año
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+# Extensiones (en minúsculas) que se muestran en la galería
+IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg"})
+
+# Calidad JPEG de los frames de vista previa
+PREVIEW_JPEG_QUALITY = 80
+
+# Buffers DMA de la vista previa: suficientes para que el ISP siga entregando
+# frames mientras Python codifica el anterior
+PREVIEW_BUFFER_COUNT = 6
+
+# Cabecera de cada parte del stream MJPEG; Content-Length evita que el navegador
+# tenga que buscar el separador dentro del JPEG
+MJPEG_PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+
+# Lectura de logs: bloque leído desde el final del archivo y máximo de líneas por petición
+LOG_TAIL_BLOCK = 8192
+LOG_TAIL_MAX_LINES = 1000
+
+# Tamaño máximo de la vista previa (el mayor que ofrece la interfaz), para que un
+# config.json editado a mano no ponga el stream a la resolución del sensor
+PREVIEW_MAX_SIZE = (1280, 720)
+
+# Tiempo máximo que /api/preview/start espera a que arranque la cámara
+PREVIEW_START_TIMEOUT = 5.0
+
+# Tiempo máximo de espera por un frame nuevo del encoder de vista previa
+PREVIEW_FRAME_TIMEOUT = 1.0
+
+# Nombres de imagen serializados por bloque al transmitir /images/<date>
+IMAGES_STREAM_CHUNK = 500
+
+# Miniaturas de la galería: se generan bajo demanda y se guardan en disco
+# dentro de base_folder (carpeta oculta, no aparece como fecha)
+THUMBNAIL_FOLDER = ".thumbs"
+THUMBNAIL_SIZE = (400, 400)
+THUMBNAIL_QUALITY = 75
+
+def json_response(data):
+    """Respuesta JSON serializada con orjson (más rápido que el json de la librería estándar)"""
+    return Response(orjson.dumps(data), mimetype='application/json')
+
+def _config_stamp():
+    """Devuelve (mtime, tamaño) del archivo de configuración o None si no existe"""
+    try:
+        st = os.stat(config_file)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def load_config(editable=False):
+    """Carga la configuración desde el archivo JSON
+
+    El contenido parseado se mantiene en memoria y solo se vuelve a leer
+    el archivo cuando cambia su fecha de modificación o su tamaño. Se devuelve
+    el diccionario de la caché, que no debe modificarse; quien vaya a cambiarlo
+    para guardarlo después debe pedir una copia con editable=True.
+    """
+    stamp = _config_stamp()
+    if stamp is not None:
+        with _config_lock:
+            if _config_cache["stamp"] != stamp:
+                try:
+                    with open(config_file, 'rb') as f:
+                        _config_cache["data"] = orjson.loads(f.read())
+                    _config_cache["stamp"] = stamp
+                except Exception as e:
+                    logger.error(f"Error al cargar configuración: {e}")
+                    _config_cache["stamp"] = None
+                    _config_cache["data"] = None
+            if _config_cache["data"] is not None:
+                if editable:
+                    return copy.deepcopy(_config_cache["data"])
+                return _config_cache["data"]
 
     # Configuración por defecto
     return {
@@ -85,153 +205,167 @@ def load_config():
 def save_config(config):
     """Guarda la configuración en el archivo JSON"""
     try:
-        with open(config_file, 'w') as f:
-            json.dump(config, f, indent=4)
+        # Escritura y caché bajo el mismo candado: la última en escribir es la que queda en ambos
+        with _config_lock:
+            write_json_atomic(config_file, config)
+            _config_cache["data"] = copy.deepcopy(config)
+            _config_cache["stamp"] = _config_stamp()
         logger.info("Configuración guardada correctamente")
         return True
     except Exception as e:
         logger.error(f"Error al guardar configuración: {e}")
         return False
 
-def read_timelapse_output(process):
-    """Lee la salida del proceso de time-lapse y la registra en el log"""
-    while not stop_log_thread.is_set() and process and process.poll() is None:
-        try:
-            # Leer la salida estándar byte a byte
-            stdout_bytes = b''
-            while True:
-                byte = process.stdout.read(1)
-                if byte == b'' or byte == b'\n':
-                    break
-                stdout_bytes += byte
-            
-            if stdout_bytes:
-                stdout_line = stdout_bytes.decode('utf-8', errors='replace').strip()
-                if stdout_line:
-                    logger.info(f"TimeLapse: {stdout_line}")
-            
-            # Leer la salida de error byte a byte
-            stderr_bytes = b''
-            while True:
-                byte = process.stderr.read(1)
-                if byte == b'' or byte == b'\n':
-                    break
-                stderr_bytes += byte
-            
-            if stderr_bytes:
-                stderr_line = stderr_bytes.decode('utf-8', errors='replace').strip()
-                if stderr_line:
-                    logger.error(f"TimeLapse Error: {stderr_line}")
-            
-            # Si no hay salida, esperar un poco
-            if not stdout_bytes and not stderr_bytes:
-                time.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error al leer la salida del proceso: {e}")
-            time.sleep(0.5)
-    
-    # Comprobar si el proceso terminó
-    if process and process.poll() is not None:
-        return_code = process.poll()
-        logger.info(f"Proceso de time-lapse terminó con código: {return_code}")
-        
-        # Leer cualquier salida restante
-        try:
-            remaining_stdout = process.stdout.read()
-            if remaining_stdout:
-                remaining_stdout_str = remaining_stdout.decode('utf-8', errors='replace').strip()
-                for line in remaining_stdout_str.split('\n'):
-                    if line.strip():
-                        logger.info(f"TimeLapse: {line}")
-            
-            remaining_stderr = process.stderr.read()
-            if remaining_stderr:
-                remaining_stderr_str = remaining_stderr.decode('utf-8', errors='replace').strip()
-                for line in remaining_stderr_str.split('\n'):
-                    if line.strip():
-                        logger.error(f"TimeLapse Error: {line}")
-        except Exception as e:
-            logger.error(f"Error al leer la salida restante: {e}")
+def is_timelapse_running():
+    """Indica si el hilo de time-lapse está en ejecución"""
+    return timelapse_thread is not None and timelapse_thread.is_alive()
 
 def start_timelapse():
-    """Inicia el proceso de time-lapse"""
-    global timelapse_process, timelapse_log_thread, stop_log_thread
+    """Inicia el time-lapse en un hilo dentro del propio proceso"""
+    global timelapse_runner, timelapse_thread
     
-    if timelapse_process and timelapse_process.poll() is None:
-        logger.info("El proceso de time-lapse ya está en ejecución")
+    if is_timelapse_running():
+        logger.info("El time-lapse ya está en ejecución")
         return True
     
     try:
-        # Detener el hilo de log anterior si existe
-        stop_log_thread.set()
-        if timelapse_log_thread and timelapse_log_thread.is_alive():
-            timelapse_log_thread.join(timeout=2)
-        
-        # Reiniciar el flag para el nuevo hilo
-        stop_log_thread.clear()
-        
-        # Iniciar el proceso con pipes para capturar la salida
-        # No usamos buffering=1 para evitar advertencias
-        timelapse_process = subprocess.Popen(
-            ["python3", "timelapse.py", "--config", config_file],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=0,  # Sin buffering
-            universal_newlines=False
-        )
-        
-        logger.info(f"Proceso de time-lapse iniciado con PID {timelapse_process.pid}")
+        # La cámara de vista previa queda abierta aunque esté detenida: liberar
+        # el dispositivo para que el time-lapse pueda abrirlo
+        with camera_lock:
+            if camera_users == 0:
+                close_camera()
         
-        # Iniciar hilo para leer la salida
-        timelapse_log_thread = threading.Thread(target=read_timelapse_output, args=(timelapse_process,))
-        timelapse_log_thread.daemon = True
-        timelapse_log_thread.start()
+        timelapse_runner = TimeLapse(config_file=config_file)
+        timelapse_thread = threading.Thread(target=timelapse_runner.run, name="TimeLapse")
+        timelapse_thread.daemon = True
+        timelapse_thread.start()
         
+        logger.info("Time-lapse iniciado")
         return True
     except Exception as e:
-        logger.error(f"Error al iniciar el proceso de time-lapse: {e}")
+        logger.error(f"Error al iniciar el time-lapse: {e}")
         return False
 
 def stop_timelapse():
-    """Detiene el proceso de time-lapse"""
-    global timelapse_process, stop_log_thread
+    """Detiene el time-lapse"""
+    global timelapse_runner, timelapse_thread
     
-    if not timelapse_process or timelapse_process.poll() is not None:
-        logger.info("No hay proceso de time-lapse en ejecución")
+    if not is_timelapse_running():
+        logger.info("No hay time-lapse en ejecución")
         return True
     
-    try:
-        # Detener el hilo de lectura de logs
-        stop_log_thread.set()
-        
-        # Enviar señal de interrupción
-        timelapse_process.send_signal(signal.SIGINT)
-        timelapse_process.wait(timeout=5)
-        logger.info("Proceso de time-lapse detenido")
-        timelapse_process = None
-        return True
-    except Exception as e:
-        logger.error(f"Error al detener el proceso de time-lapse: {e}")
+    # Pedir la parada y esperar a que se escriban las imágenes pendientes
+    timelapse_runner.stop()
+    timelapse_thread.join(timeout=10)
+    if timelapse_thread.is_alive():
+        logger.error("El time-lapse no se detuvo a tiempo")
+        return False
+    
+    logger.info("Time-lapse detenido")
+    timelapse_runner = None
+    timelapse_thread = None
+    return True
+
+class StreamingOutput(io.BufferedIOBase):
+    """Destino del encoder JPEG de la vista previa: guarda el último frame
+
+    Los consumidores esperan en la condición en lugar de capturar ellos mismos,
+    así que todos los clientes comparten el mismo frame codificado.
+    """
+    def __init__(self):
+        self.frame = None
+        self.sequence = 0
+        self.condition = threading.Condition()
+    
+    def write(self, buf):
+        with self.condition:
+            self.frame = buf
+            self.sequence += 1
+            self.condition.notify_all()
+        return len(buf)
+    
+    def reset(self):
+        """Descarta el último frame (p. ej. el de una sesión anterior de la cámara)"""
+        with self.condition:
+            self.frame = None
+    
+    def wait_frame(self, last_sequence=None, timeout=PREVIEW_FRAME_TIMEOUT):
+        """Devuelve (secuencia, frame) del frame más reciente posterior a last_sequence
+
+        Si ya hay uno más nuevo que el último entregado se devuelve sin esperar;
+        frame es None si no llega ninguno a tiempo.
+        """
+        with self.condition:
+            ready = self.condition.wait_for(
+                lambda: self.frame is not None and self.sequence != last_sequence, timeout)
+            if not ready:
+                return last_sequence, None
+            return self.sequence, self.frame
+
+preview_output = StreamingOutput()
+
+def close_camera():
+    """Detiene el encoder y cierra la cámara de vista previa si está abierta
+
+    Libera el dispositivo; para dejar de usar la cámara sin cerrarla, ver release_camera.
+    """
+    global camera
+    
+    with camera_lock:
+        if camera is None:
+            return
+        try:
+            camera.stop_recording()
+        except Exception as e:
+            logger.error(f"Error al detener la cámara: {e}")
+        # close() se intenta siempre: si no, el dispositivo quedaría ocupado sin
+        # ninguna referencia para liberarlo
         try:
-            timelapse_process.kill()
-            logger.info("Proceso de time-lapse terminado forzosamente")
-            timelapse_process = None
-            return True
-        except:
-            return False
+            camera.close()
+        except Exception as e:
+            logger.error(f"Error al cerrar la cámara: {e}")
+        finally:
+            camera = None
+
+def clamp_preview_size(width, height):
+    """Reduce el tamaño de vista previa a PREVIEW_MAX_SIZE conservando la proporción"""
+    scale = min(1.0, PREVIEW_MAX_SIZE[0] / width, PREVIEW_MAX_SIZE[1] / height)
+    # YUV420 necesita dimensiones pares
+    return int(width * scale) & ~1, int(height * scale) & ~1
+
+def pause_camera():
+    """Detiene la cámara y el encoder de vista previa sin cerrarla
+
+    La instancia de Picamera2 sigue abierta y configurada, así que volver a
+    arrancarla no reabre el dispositivo ni reserva de nuevo los buffers.
+    """
+    with camera_lock:
+        if camera is None or not camera.started:
+            return
+        try:
+            camera.stop_recording()
+        except Exception as e:
+            logger.error(f"Error al detener la cámara: {e}")
+
+def resume_camera():
+    """Arranca la cámara ya configurada junto con el encoder de vista previa
+
+    Sirve tanto para el primer arranque como para reanudar tras pause_camera.
+    Debe llamarse con camera_lock adquirido.
+    """
+    # Se descarta el último frame de la sesión anterior
+    preview_output.reset()
+    camera.start_recording(JpegEncoder(q=PREVIEW_JPEG_QUALITY), FileOutput(preview_output))
 
 def initialize_camera(for_preview=True):
-    """Inicializa la cámara con la configuración adecuada"""
+    """Inicializa la cámara con la configuración adecuada
+
+    Debe llamarse con camera_lock adquirido (ver get_camera).
+    """
     global camera
 
     # Si hay una instancia de cámara activa, cerrarla primero
-    if camera:
-        try:
-            camera.stop()
-            camera.close()
-        except:
-            pass
-        camera = None
+    close_camera()
 
     try:
         logger.info("Inicializando cámara...")
@@ -240,23 +374,25 @@ def initialize_camera(for_preview=True):
         
         if for_preview:
             # Usar una resolución más baja para la vista previa
-            preview_width = config["preview_resolution"]["width"]
-            preview_height = config["preview_resolution"]["height"]
+            preview_width, preview_height = clamp_preview_size(
+                config["preview_resolution"]["width"], config["preview_resolution"]["height"])
             logger.info(f"Configurando vista previa: {preview_width}x{preview_height} a 60 FPS")
             
             # Configuración para vista previa con alto FPS
             try:
                 preview_config = camera.create_video_configuration(
-                    main={"size": (preview_width, preview_height), "format": "XRGB8888"},
-                    controls={"FrameRate": 60.0, "NoiseReductionMode": 0}
+                    main={"size": (preview_width, preview_height), "format": "YUV420"},
+                    controls={"FrameRate": 60.0, "NoiseReductionMode": 0},
+                    buffer_count=PREVIEW_BUFFER_COUNT
                 )
                 camera.configure(preview_config)
             except Exception as e:
                 logger.error(f"Error con resolución de vista previa {preview_width}x{preview_height}: {e}")
                 # Usar una resolución más baja si falla
                 preview_config = camera.create_video_configuration(
-                    main={"size": (640, 480), "format": "XRGB8888"},
-                    controls={"FrameRate": 60.0, "NoiseReductionMode": 0}
+                    main={"size": (640, 480), "format": "YUV420"},
+                    controls={"FrameRate": 60.0, "NoiseReductionMode": 0},
+                    buffer_count=PREVIEW_BUFFER_COUNT
                 )
                 camera.configure(preview_config)
         else:
@@ -278,27 +414,76 @@ def initialize_camera(for_preview=True):
                 )
                 camera.configure(still_config)
             
-        camera.start()
-        time.sleep(2)  # Dar tiempo a que la cámara se inicialice
+        if for_preview:
+            # El encoder JPEG corre en su propio hilo y publica cada frame en preview_output
+            resume_camera()
+        else:
+            camera.start()
+        wait_for_camera_ready(camera)
         logger.info("Cámara inicializada correctamente")
         return True
     except Exception as e:
         logger.error(f"Error al inicializar la cámara: {e}")
         return False
 
-def capture_preview_image():
-    """Captura una imagen de vista previa"""
-    global camera, latest_preview_image
+def get_camera():
+    """Devuelve la cámara de vista previa en marcha, abriéndola o reanudándola si hace falta
+
+    Es el único punto de entrada para abrir la cámara: la comprobación y la
+    inicialización ocurren bajo camera_lock, así que dos peticiones simultáneas
+    no pueden crear dos instancias de Picamera2. La cámara se abre una sola vez;
+    si solo estaba detenida se reanuda sin reconfigurarla y se espera a que se
+    estabilicen la exposición y el balance de blancos. Devuelve None si falla.
+    """
+    with camera_lock:
+        if camera is None:
+            if not initialize_camera(for_preview=True):
+                return None
+        elif not camera.started:
+            try:
+                resume_camera()
+                # El primer frame tras reanudar aún no tiene la exposición ni el balance ajustados
+                wait_for_camera_ready(camera)
+            except Exception as e:
+                logger.error(f"Error al reanudar la cámara: {e}")
+                close_camera()
+                return None
+        return camera
+
+def acquire_camera():
+    """Registra un usuario de la cámara de vista previa y la devuelve en marcha
+
+    Cada llamada que no devuelva None debe ir seguida de release_camera.
+    """
+    global camera_users
     
-    if not camera:
-        if not initialize_camera(for_preview=True):
+    with camera_lock:
+        if get_camera() is None:
             return None
+        camera_users += 1
+        return camera
+
+def release_camera():
+    """Da de baja un usuario de la cámara; el último la detiene (sin cerrarla)"""
+    global camera_users
+    
+    with camera_lock:
+        camera_users = max(camera_users - 1, 0)
+        if camera_users == 0:
+            pause_camera()
+
+def capture_preview_image():
+    """Captura una imagen de vista previa
+
+    Devuelve el frame más reciente del encoder; la cámara debe estar en marcha.
+    """
+    global latest_preview_image
     
     try:
-        output = io.BytesIO()
-        camera.capture_file(output, format='jpeg')
-        latest_preview_image = base64.b64encode(output.getvalue()).decode('utf-8')
-        output.close()
+        _, frame = preview_output.wait_frame()
+        if frame is None:
+            return None
+        latest_preview_image = frame
         return latest_preview_image
     except Exception as e:
         logger.error(f"Error al capturar imagen de vista previa: {e}")
@@ -306,86 +491,78 @@ def capture_preview_image():
 
 def generate_frames():
     """Genera frames para el streaming de video en tiempo real"""
-    global camera, stop_preview_event
+    global stop_preview_event
     
-    with camera_lock:
-        if not camera and not initialize_camera(for_preview=True):
-            return
+    if acquire_camera() is None:
+        return
     
+    sequence = None
     try:
         while not stop_preview_event.is_set():
-            output = io.BytesIO()
-            with camera_lock:
-                camera.capture_file(output, format='jpeg')
-            frame = output.getvalue()
-            output.close()
-            
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+            # El ritmo lo marca el encoder: cada cliente toma el frame más reciente que
+            # aún no ha enviado y, si no lo hay, espera al siguiente
+            sequence, frame = preview_output.wait_frame(sequence)
+            if frame is None:
+                continue
             
-            # Control de velocidad de frames - reducir para permitir que la cámara capture a mayor velocidad
-            time.sleep(0.01)  # Aproximadamente 100 FPS máximo (limitado por la cámara)
+            # Cabecera, frame y cierre por separado: sin concatenar (copiar) el JPEG por cliente
+            yield MJPEG_PART_HEADER % len(frame)
+            yield frame
+            yield b'\r\n'
     except Exception as e:
         logger.error(f"Error en streaming de video: {e}")
     finally:
-        if camera and not timelapse_process:
-            with camera_lock:
-                try:
-                    camera.stop()
-                    camera.close()
-                    camera = None
-                except:
-                    pass
+        release_camera()
 
 def preview_manager():
     """Gestiona el hilo de vista previa"""
-    global preview_active, stop_preview_event, camera
+    global preview_active, stop_preview_event
     
     stop_preview_event.clear()
     preview_active = True
+    acquired = False
     
     try:
         # Inicializar la cámara si no está inicializada
-        with camera_lock:
-            if not camera:
-                if not initialize_camera(for_preview=True):
-                    logger.error("No se pudo inicializar la cámara para vista previa")
-                    preview_active = False
-                    return
+        acquired = acquire_camera() is not None
+        if not acquired:
+            logger.error("No se pudo inicializar la cámara para vista previa")
+            preview_active = False
+            return
+        preview_ready.set()
         
-        # Capturar imágenes mientras la vista previa esté activa
-        while not stop_preview_event.is_set():
-            with camera_lock:
-                capture_preview_image()
-            time.sleep(0.1)  # Actualizar más rápido (10 veces por segundo)
+        # El encoder publica los frames por su cuenta; solo queda esperar a que se detenga
+        stop_preview_event.wait()
             
     except Exception as e:
         logger.error(f"Error en preview_manager: {e}")
     finally:
-        # Limpiar recursos si no está en uso por timelapse
-        if not timelapse_process:
-            with camera_lock:
-                if camera:
-                    try:
-                        camera.stop()
-                        camera.close()
-                        camera = None
-                    except:
-                        pass
+        # Si nadie más la usa, la cámara se detiene pero queda abierta para la próxima vista previa
+        if acquired:
+            release_camera()
         
         preview_active = False
+        preview_ready.set()
         logger.info("Vista previa detenida")
 
 @app.route('/')
 def index():
-    """Página principal"""
-    config = load_config()
-    return render_template('index.html', config=config, resolution_presets=RESOLUTION_PRESETS)
+    """Página principal
+
+    La plantilla no depende de la configuración (la página la pide a /api/config),
+    así que se renderiza una vez y se vuelve a renderizar solo si cambia el archivo.
+    """
+    template_path = os.path.join(app.root_path, app.template_folder, 'index.html')
+    stamp = os.stat(template_path).st_mtime_ns
+    if _index_cache["stamp"] != stamp:
+        _index_cache["body"] = render_template('index.html', resolution_presets=RESOLUTION_PRESETS)
+        _index_cache["stamp"] = stamp
+    return conditional_response(Response(_index_cache["body"], mimetype='text/html'), stamp)
 
 @app.route('/api/config', methods=['GET'])
 def get_config():
     """Obtiene la configuración actual"""
-    return jsonify(load_config())
+    return json_response(load_config())
 
 @app.route('/api/config', methods=['POST'])
 def update_config():
@@ -393,84 +570,198 @@ def update_config():
     try:
         config = request.json
         if save_config(config):
-            return jsonify({"success": True, "message": "Configuración actualizada correctamente"})
+            return json_response({"success": True, "message": "Configuración actualizada correctamente"})
         else:
-            return jsonify({"success": False, "message": "Error al guardar la configuración"}), 500
+            return json_response({"success": False, "message": "Error al guardar la configuración"}), 500
     except Exception as e:
         logger.error(f"Error al actualizar configuración: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+        return json_response({"success": False, "message": str(e)}), 500
 
 @app.route('/api/resolution/presets', methods=['GET'])
 def get_resolution_presets():
     """Obtiene las resoluciones predefinidas"""
-    return jsonify(RESOLUTION_PRESETS)
+    response = Response(RESOLUTION_PRESETS_JSON, mimetype='application/json')
+    response.set_etag(RESOLUTION_PRESETS_ETAG)
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return response.make_conditional(request)
 
 @app.route('/api/start', methods=['POST'])
 def api_start_timelapse():
     """Inicia el proceso de time-lapse"""
     if start_timelapse():
-        return jsonify({"success": True, "message": "Time-lapse iniciado correctamente"})
+        return json_response({"success": True, "message": "Time-lapse iniciado correctamente"})
     else:
-        return jsonify({"success": False, "message": "Error al iniciar el time-lapse"}), 500
+        return json_response({"success": False, "message": "Error al iniciar el time-lapse"}), 500
 
 @app.route('/api/stop', methods=['POST'])
 def api_stop_timelapse():
     """Detiene el proceso de time-lapse"""
     if stop_timelapse():
-        return jsonify({"success": True, "message": "Time-lapse detenido correctamente"})
+        return json_response({"success": True, "message": "Time-lapse detenido correctamente"})
     else:
-        return jsonify({"success": False, "message": "Error al detener el time-lapse"}), 500
+        return json_response({"success": False, "message": "Error al detener el time-lapse"}), 500
 
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Obtiene el estado actual del time-lapse"""
-    is_running = timelapse_process is not None and timelapse_process.poll() is None
-    return jsonify({
+    is_running = is_timelapse_running()
+    return json_response({
         "running": is_running,
-        "pid": timelapse_process.pid if is_running else None,
+        "pid": os.getpid() if is_running else None,
         "preview_active": preview_active
     })
 
+def _scan_date_folders(path):
+    """Lista las carpetas de fechas, de la más reciente a la más antigua"""
+    with os.scandir(path) as it:
+        folders = [e.name for e in it if not e.name.startswith('.') and e.is_dir(follow_symlinks=False)]
+    folders.sort(reverse=True)
+    return tuple(folders)
+
+def _scan_images(path):
+    """Lista las imágenes JPEG de una carpeta en orden"""
+    with os.scandir(path) as it:
+        images = [e.name for e in it
+                  if e.name.rpartition('.')[2].lower() in IMAGE_EXTENSIONS
+                  and e.is_file(follow_symlinks=False)]
+    images.sort()
+    return tuple(images)
+
+def cached_listing(path, scan):
+    """Devuelve (mtime, listado) de una carpeta, recalculando el listado solo cuando cambia su mtime
+
+    Lanza FileNotFoundError si la carpeta no existe.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with _listing_lock:
+        cached = _listing_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached
+    
+    cached = (mtime, scan(path))
+    with _listing_lock:
+        _listing_cache[path] = cached
+    return cached
+
+def conditional_response(response, mtime):
+    """Marca una respuesta con ETag/Last-Modified a partir del mtime de su origen
+    (carpeta o plantilla) y responde 304 si el navegador ya la tiene"""
+    # El ETag usa el mtime en nanosegundos: Last-Modified solo tiene resolución de segundos
+    response.set_etag(str(mtime))
+    response.last_modified = mtime / 1e9
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+def _stream_images_json(date, images, offset, end):
+    """Genera la respuesta JSON de /images/<date> por bloques
+
+    Solo se serializan las imágenes de [offset, end); "count" es el total de la carpeta.
+    """
+    yield b'{"date":' + orjson.dumps(date) + b',"offset":%d,"images":[' % offset
+    for start in range(offset, end, IMAGES_STREAM_CHUNK):
+        chunk = orjson.dumps(images[start:min(start + IMAGES_STREAM_CHUNK, end)])[1:-1]
+        yield chunk if start == offset else b"," + chunk
+    yield b'],"count":%d}' % len(images)
+
 @app.route('/images')
 def images_list():
-    """Lista todas las carpetas de imágenes disponibles"""
+    """Lista las carpetas de imágenes disponibles, opcionalmente solo las N más recientes"""
     config = load_config()
     base_folder = config["base_folder"]
+    limit = request.args.get('limit', type=int)
     
-    if not os.path.exists(base_folder):
-        return jsonify({"folders": []})
+    try:
+        mtime, folders = cached_listing(base_folder, _scan_date_folders)
+    except FileNotFoundError:
+        return json_response({"folders": []})
     
-    folders = [f for f in os.listdir(base_folder) 
-               if os.path.isdir(os.path.join(base_folder, f))]
-    folders.sort(reverse=True)  # Ordenar por fecha descendente
+    # El listado en caché ya está ordenado (YYYY-MM-DD: orden lexicográfico == cronológico),
+    # así que las N más recientes son un simple corte
+    if limit is not None and limit >= 0:
+        folders = folders[:limit]
     
-    return jsonify({"folders": folders})
+    return conditional_response(json_response({"folders": folders}), mtime)
 
 @app.route('/images/<date>')
 def images_by_date(date):
-    """Lista todas las imágenes para una fecha específica"""
+    """Lista las imágenes de una fecha, opcionalmente paginadas con ?offset=&limit="""
     config = load_config()
     date_folder = os.path.join(config["base_folder"], date)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', type=int)
     
-    if not os.path.exists(date_folder):
-        return jsonify({"images": []})
-    
-    images = [f for f in os.listdir(date_folder) 
-              if f.endswith('.jpg')]
-    images.sort()
+    try:
+        mtime, images = cached_listing(date_folder, _scan_images)
+    except FileNotFoundError:
+        return json_response({"images": []})
     
-    return jsonify({
-        "date": date,
-        "images": images,
-        "count": len(images)
-    })
+    # Transmitir por bloques para no construir el JSON completo en memoria
+    # El listado en caché ya está ordenado, así que una página es un rango de índices
+    offset = min(offset, len(images))
+    end = len(images) if limit is None or limit < 0 else min(offset + limit, len(images))
+    response = Response(_stream_images_json(date, images, offset, end), mimetype='application/json')
+    return conditional_response(response, mtime)
 
 @app.route('/images/<date>/<image>')
 def get_image(date, image):
     """Devuelve una imagen específica"""
     config = load_config()
+    
+    accel_prefix = app.config.get("ACCEL_REDIRECT_PREFIX")
+    if accel_prefix:
+        # Detrás de nginx: el proxy envía el archivo con sendfile y Python no lee sus bytes
+        path = safe_join(config["base_folder"], date, image)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = Response(mimetype='image/jpeg')
+        # nginx decodifica la URI: los segmentos van codificados para que %, ?, # o
+        # espacios en el nombre no apunten a otra ruta interna
+        response.headers["X-Accel-Redirect"] = f"{accel_prefix.rstrip('/')}/{quote(date)}/{quote(image)}"
+        response.headers["Cache-Control"] = f"public, max-age={IMAGE_MAX_AGE}, immutable"
+        return response
+    
     date_folder = os.path.join(config["base_folder"], date)
-    return send_from_directory(date_folder, image)
+    # ETag y Last-Modified se calculan a partir de mtime/tamaño, sin leer el archivo,
+    # y las peticiones condicionales se responden con 304
+    response = send_from_directory(date_folder, image, conditional=True, etag=True, max_age=IMAGE_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={IMAGE_MAX_AGE}, immutable"
+    return response
+
+def _generate_thumbnail(source, target):
+    """Crea la miniatura de una imagen de forma atómica"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    buffer = io.BytesIO()
+    with Image.open(source) as img:
+        # Decodificar el JPEG ya reducido (escalado DCT) evita descomprimir
+        # la imagen completa de hasta 64MP
+        img.draft("RGB", THUMBNAIL_SIZE)
+        img.thumbnail(THUMBNAIL_SIZE)
+        img.save(buffer, "JPEG", quality=THUMBNAIL_QUALITY)
+    write_file_atomic(target, buffer.getvalue())
+
+@app.route('/images/<date>/<image>/thumb')
+def get_thumbnail(date, image):
+    """Devuelve la miniatura de una imagen, generándola la primera vez"""
+    config = load_config()
+    base_folder = config["base_folder"]
+    source = safe_join(base_folder, date, image)
+    target = safe_join(base_folder, THUMBNAIL_FOLDER, date, image)
+    if source is None or target is None or not os.path.isfile(source):
+        abort(404)
+    
+    if not os.path.exists(target):
+        lock = _thumbnail_locks[hash(target) % THUMBNAIL_LOCK_COUNT]
+        try:
+            with lock:
+                if not os.path.exists(target):
+                    _generate_thumbnail(source, target)
+        except Exception as e:
+            logger.error(f"Error al generar la miniatura de {source}: {e}")
+            abort(500)
+    
+    response = send_file(target, mimetype='image/jpeg', conditional=True, etag=True, max_age=IMAGE_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={IMAGE_MAX_AGE}, immutable"
+    return response
 
 @app.route('/video_feed')
 def video_feed():
@@ -480,21 +771,30 @@ def video_feed():
 
 @app.route('/api/preview/image', methods=['GET'])
 def get_preview_image():
-    """Devuelve la última imagen de vista previa como base64"""
-    global latest_preview_image
+    """Devuelve la última imagen de vista previa como JPEG (o como base64 con ?format=json)"""
+    # Con la vista previa activa el encoder ya está publicando frames: se sirve el último
+    # sin tocar camera_lock, que puede estar ocupado por una captura de foto
+    frame = preview_output.frame if preview_active else None
     
-    # Si no hay imagen de vista previa o la vista previa no está activa, capturar una nueva
-    if not latest_preview_image or not preview_active:
-        with camera_lock:
-            if not preview_active:
-                if not initialize_camera(for_preview=True):
-                    return jsonify({"success": False, "message": "Error al inicializar la cámara"}), 500
-            capture_preview_image()
+    if frame is None:
+        # Si la cámara no está en marcha, arrancarla para obtener un frame
+        if acquire_camera() is None:
+            return json_response({"success": False, "message": "Error al inicializar la cámara"}), 500
+        
+        # Se usa el frame más reciente del encoder, sin capturar de nuevo
+        try:
+            frame = capture_preview_image()
+        finally:
+            release_camera()
     
-    if latest_preview_image:
-        return jsonify({"success": True, "image": latest_preview_image})
+    if frame and request.args.get('format') == 'json':
+        return json_response({"success": True, "image": base64.b64encode(frame).decode('ascii')})
+    elif frame:
+        response = Response(frame, mimetype='image/jpeg')
+        response.headers["Cache-Control"] = "no-store"
+        return response
     else:
-        return jsonify({"success": False, "message": "No se pudo obtener la imagen de vista previa"}), 500
+        return json_response({"success": False, "message": "No se pudo obtener la imagen de vista previa"}), 500
 
 @app.route('/api/preview/start', methods=['POST'])
 def start_preview():
@@ -502,7 +802,7 @@ def start_preview():
     global preview_thread, preview_active, stop_preview_event
     
     if preview_active:
-        return jsonify({"success": True, "message": "Vista previa ya está activa"})
+        return json_response({"success": True, "message": "Vista previa ya está activa"})
     
     # Detener la vista previa si está activa
     stop_preview_event.set()
@@ -511,18 +811,19 @@ def start_preview():
     
     # Iniciar nuevo hilo de vista previa
     stop_preview_event.clear()
+    preview_ready.clear()
     preview_thread = threading.Thread(target=preview_manager)
     preview_thread.daemon = True
     preview_thread.start()
     
-    # Esperar un momento para asegurarse de que la vista previa se inicie
-    time.sleep(1)
+    # Esperar a que la cámara haya arrancado (o fallado), no un tiempo fijo
+    preview_ready.wait(PREVIEW_START_TIMEOUT)
     
     # Verificar si se inició correctamente
     if preview_active:
-        return jsonify({"success": True, "message": "Vista previa iniciada correctamente"})
+        return json_response({"success": True, "message": "Vista previa iniciada correctamente"})
     else:
-        return jsonify({"success": False, "message": "Error al iniciar vista previa"}), 500
+        return json_response({"success": False, "message": "Error al iniciar vista previa"}), 500
 
 @app.route('/api/preview/stop', methods=['POST'])
 def stop_preview_route():
@@ -531,118 +832,147 @@ def stop_preview_route():
     
     stop_preview_event.set()
     
-    return jsonify({"success": True, "message": "Vista previa detenida correctamente"})
+    return json_response({"success": True, "message": "Vista previa detenida correctamente"})
+
+def tail_lines(path, num_lines):
+    """Devuelve las últimas num_lines líneas de un archivo leyendo solo su final
+
+    Se leen bloques desde el final hasta reunir suficientes saltos de línea,
+    así que el coste no depende del tamaño del archivo.
+    """
+    if num_lines <= 0:
+        return []
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return []
+    
+    with f:
+        position = f.seek(0, os.SEEK_END)
+        chunks = []
+        newlines = 0
+        while position > 0 and newlines <= num_lines:
+            size = min(LOG_TAIL_BLOCK, position)
+            position -= size
+            f.seek(position)
+            chunk = f.read(size)
+            chunks.append(chunk)
+            newlines += chunk.count(b'\n')
+    
+    data = b''.join(reversed(chunks)).decode('utf-8', errors='replace')
+    return data.splitlines(keepends=True)[-num_lines:]
 
 @app.route('/api/logs', methods=['GET'])
 def get_logs():
     """Obtiene los últimos logs de la aplicación"""
-    num_lines = request.args.get('lines', default=50, type=int)
+    num_lines = min(request.args.get('lines', default=50, type=int), LOG_TAIL_MAX_LINES)
     
     try:
-        # Leer logs del timelapse
-        timelapse_logs = []
-        if os.path.exists('timelapse.log'):
-            with open('timelapse.log', 'r') as f:
-                timelapse_logs = f.readlines()
-                timelapse_logs = timelapse_logs[-num_lines:] if len(timelapse_logs) > num_lines else timelapse_logs
-        
-        # Leer logs de la webapp
-        webapp_logs = []
-        if os.path.exists('webapp.log'):
-            with open('webapp.log', 'r') as f:
-                webapp_logs = f.readlines()
-                webapp_logs = webapp_logs[-num_lines:] if len(webapp_logs) > num_lines else webapp_logs
-        
-        return jsonify({
-            "timelapse_logs": timelapse_logs,
-            "webapp_logs": webapp_logs
+        response = json_response({
+            "timelapse_logs": tail_lines('timelapse.log', num_lines),
+            "webapp_logs": tail_lines('webapp.log', num_lines)
         })
+        # Los logs cambian continuamente: el navegador no debe reutilizar una respuesta
+        response.headers["Cache-Control"] = "no-store"
+        return response
     except Exception as e:
         logger.error(f"Error al leer logs: {e}")
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}), 500
 
 @app.route('/api/photo/capture', methods=['POST'])
 def capture_photo():
     """Captura una fotografía única de alta calidad"""
-    # Detener vista previa temporalmente si está activa
-    was_preview_active = preview_active
-    if was_preview_active:
-        stop_preview_route()
-        time.sleep(1)  # Dar tiempo a que se libere la cámara
+    # Si la vista previa está activa, la foto se toma cambiando de modo la misma cámara
+    return json_response(capture_single_photo())
+
+def _photo_filename(base_folder, prefix):
+    """Genera la ruta de una foto nueva, creando la carpeta del día si hace falta"""
+    date_folder, timestamp = format_capture_time(datetime.datetime.now())
+    day_folder = os.path.join(base_folder, date_folder)
+    if day_folder not in _photo_folders:
+        os.makedirs(day_folder, exist_ok=True)
+        _photo_folders.add(day_folder)
     
-    # Capturar la foto
-    result = capture_single_photo()
+    # Número de la foto dentro del día; solo se cuenta la carpeta la primera vez
+    key = (day_folder, prefix)
+    with _photo_counters_lock:
+        if key not in _photo_counters:
+            # Las entradas de otros días ya no se usarán
+            for old_key in [k for k in _photo_counters if k[0] != day_folder]:
+                del _photo_counters[old_key]
+            try:
+                with os.scandir(day_folder) as entries:
+                    _photo_counters[key] = sum(1 for entry in entries if entry.name.startswith(prefix))
+            except Exception as e:
+                logger.error(f"Error al contar imágenes existentes: {e}")
+                _photo_counters[key] = 0
+        _photo_counters[key] += 1
+        image_count = _photo_counters[key]
     
-    # Reiniciar vista previa si estaba activa
-    if was_preview_active:
-        start_preview()
+    return date_folder, os.path.join(day_folder, f"{prefix}_{timestamp}_{image_count:03d}.jpg")
+
+def capture_single_photo(prefix="PHOTO", config=None):
+    """Captura una foto única de alta calidad
+
+    Quien captura en bucle (el timelapse fotográfico) puede pasar la configuración
+    ya cargada para no consultarla en cada foto.
+    """
+    if config is None:
+        config = load_config()
+    base_folder = config["base_folder"]
     
-    return jsonify(result)
+    # Usar la resolución configurada para captura
+    width = config["resolution"]["width"]
+    height = config["resolution"]["height"]
+    
+    # La foto se toma siempre con la cámara compartida: si no está abierta se abre
+    # una vez y después queda detenida para las siguientes fotos o la vista previa
+    with camera_lock:
+        if acquire_camera() is None:
+            return {"success": False, "error": "Error al inicializar la cámara"}
+        try:
+            return _capture_photo_switch_mode(base_folder, prefix, width, height)
+        finally:
+            release_camera()
 
-def capture_single_photo(prefix="PHOTO"):
-    """Captura una foto única de alta calidad"""
+def _capture_photo_switch_mode(base_folder, prefix, width, height):
+    """Captura una foto con la cámara de vista previa ya en marcha
+
+    Se detiene solo el encoder de la vista previa, se cambia a la configuración
+    de foto para un frame y se vuelve al modo de vista previa, sin cerrar ni
+    reabrir la cámara. Debe llamarse con camera_lock adquirido.
+    """
+    filename = None
     try:
-        logger.info("Inicializando cámara para captura fotográfica única...")
-        photo_camera = Picamera2()
-        config = load_config()
-        
-        # Usar la resolución configurada para captura
-        width = config["resolution"]["width"]
-        height = config["resolution"]["height"]
-        logger.info(f"Configurando captura fotográfica: {width}x{height}")
-        
-        # Configuración específica para fotografía de alta calidad
-        still_config = photo_camera.create_still_configuration(
-            main={"size": (width, height)}
-        )
-        photo_camera.configure(still_config)
-        photo_camera.start()
-        
-        # Esperar para que la exposición automática se estabilice
-        time.sleep(2)
+        logger.info(f"Captura fotográfica {width}x{height} con cambio de modo")
+        still_config = camera.create_still_configuration(main={"size": (width, height)})
+        date_folder, filename = _photo_filename(base_folder, prefix)
         
-        # Crear nombre de archivo
-        now = datetime.datetime.now()
-        date_folder = now.strftime("%Y-%m-%d")
-        timestamp = now.strftime("%Y%m%d_%H%M%S")
-        
-        # Asegurar que existe la carpeta
-        base_folder = config["base_folder"]
-        if not os.path.exists(base_folder):
-            os.makedirs(base_folder)
-        
-        day_folder = os.path.join(base_folder, date_folder)
-        if not os.path.exists(day_folder):
-            os.makedirs(day_folder)
-            
-        # Contar imágenes existentes
+        camera.stop_encoder()
         try:
-            existing_images = [f for f in os.listdir(day_folder) if f.startswith(prefix)]
-            image_count = len(existing_images) + 1
-        except Exception as e:
-            logger.error(f"Error al contar imágenes existentes: {e}")
-            image_count = 1
-            
-        # Generar nombre de archivo
-        filename = os.path.join(day_folder, f"{prefix}_{timestamp}_{image_count:03d}.jpg")
-        
-        # Capturar imagen con máxima calidad
-        photo_camera.capture_file(filename)
+            # Se guarda con un nombre temporal oculto y se renombra al terminar, para que
+            # la galería no sirva (ni cachee) un JPEG a medio escribir
+            tmp_filename = os.path.join(os.path.dirname(filename), f".{os.path.basename(filename)}.tmp")
+            try:
+                camera.switch_mode_and_capture_file(still_config, tmp_filename, format="jpeg")
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                # No dejar temporales a tamaño completo en la carpeta del día
+                try:
+                    os.unlink(tmp_filename)
+                except FileNotFoundError:
+                    pass
+                raise
+        finally:
+            camera.start_encoder(JpegEncoder(q=PREVIEW_JPEG_QUALITY), FileOutput(preview_output))
         logger.info(f"Foto capturada: {filename}")
         
-        # Cerrar la cámara
-        photo_camera.stop()
-        photo_camera.close()
-        
         return {"success": True, "filename": filename, "path": f"/images/{date_folder}/{os.path.basename(filename)}"}
     except Exception as e:
         logger.error(f"Error al capturar foto: {e}")
-        try:
-            if 'photo_camera' in locals() and photo_camera:
-                photo_camera.stop()
-                photo_camera.close()
-        except:
-            pass
+        # La carpeta pudo haberse borrado externamente; volver a crearla en la próxima foto
+        if filename is not None:
+            _photo_folders.discard(os.path.dirname(filename))
         return {"success": False, "error": str(e)}
 
 def photo_timelapse_worker():
@@ -670,18 +1000,8 @@ def photo_timelapse_worker():
             
         # Capturar imagen cuando sea el momento
         if current_time >= next_capture:
-            # Detener vista previa temporalmente si está activa
-            was_preview_active = preview_active
-            if was_preview_active:
-                stop_preview_route()
-                time.sleep(0.5)
-            
-            # Capturar foto
-            result = capture_single_photo(prefix=prefix)
-            
-            # Reiniciar vista previa si estaba activa
-            if was_preview_active:
-                start_preview()
+            # Capturar foto (con la cámara de vista previa si está activa)
+            result = capture_single_photo(prefix=prefix, config=config)
                 
             if result["success"]:
                 logger.info(f"Imagen de timelapse fotográfico capturada: {result['filename']}")
@@ -691,8 +1011,12 @@ def photo_timelapse_worker():
             # Programar próxima captura
             next_capture = time.time() + interval
         
-        # Pequeña pausa para evitar uso excesivo de CPU
-        time.sleep(0.1)
+        # Dormir hasta la próxima captura (o el final de la duración); el evento
+        # de parada despierta el hilo en cuanto se pide detenerlo
+        wake_time = next_capture
+        if duration > 0:
+            wake_time = min(wake_time, start_time + duration)
+        stop_photo_timelapse.wait(max(0.0, wake_time - time.time()))
     
     photo_timelapse_active = False
     logger.info("Timelapse fotográfico detenido")
@@ -703,11 +1027,11 @@ def start_photo_timelapse():
     global photo_timelapse_active, photo_timelapse_thread, stop_photo_timelapse
     
     if photo_timelapse_active:
-        return jsonify({"success": False, "message": "El timelapse fotográfico ya está activo"})
+        return json_response({"success": False, "message": "El timelapse fotográfico ya está activo"})
     
     # Actualizar configuración si se proporcionan parámetros
     if request.json:
-        config = load_config()
+        config = load_config(editable=True)
         if "interval_seconds" in request.json:
             config["photo_timelapse"]["interval_seconds"] = int(request.json["interval_seconds"])
         if "duration_minutes" in request.json:
@@ -727,7 +1051,7 @@ def start_photo_timelapse():
     
     photo_timelapse_active = True
     
-    return jsonify({
+    return json_response({
         "success": True, 
         "message": "Timelapse fotográfico iniciado",
         "config": load_config()["photo_timelapse"]
@@ -739,7 +1063,7 @@ def api_stop_photo_timelapse():
     global photo_timelapse_active, stop_photo_timelapse
     
     if not photo_timelapse_active:
-        return jsonify({"success": False, "message": "El timelapse fotográfico no está activo"})
+        return json_response({"success": False, "message": "El timelapse fotográfico no está activo"})
     
     # Señalizar al hilo que debe detenerse
     stop_photo_timelapse.set()
@@ -749,18 +1073,18 @@ def api_stop_photo_timelapse():
         photo_timelapse_thread.join(timeout=2)
     
     # Actualizar configuración
-    config = load_config()
+    config = load_config(editable=True)
     config["photo_timelapse"]["enabled"] = False
     save_config(config)
     
-    return jsonify({"success": True, "message": "Timelapse fotográfico detenido"})
+    return json_response({"success": True, "message": "Timelapse fotográfico detenido"})
 
 @app.route('/api/photo/timelapse/status', methods=['GET'])
 def photo_timelapse_status():
     """Devuelve el estado actual del timelapse fotográfico"""
     config = load_config()
     
-    return jsonify({
+    return json_response({
         "active": photo_timelapse_active,
         "config": config["photo_timelapse"]
     })
@@ -769,9 +1093,9 @@ def photo_timelapse_status():
 def update_photo_timelapse_config():
     """Actualiza la configuración del timelapse fotográfico"""
     if not request.json:
-        return jsonify({"success": False, "message": "No se proporcionaron datos de configuración"})
+        return json_response({"success": False, "message": "No se proporcionaron datos de configuración"})
     
-    config = load_config()
+    config = load_config(editable=True)
     
     # Actualizar configuración
     if "interval_seconds" in request.json:
@@ -784,31 +1108,51 @@ def update_photo_timelapse_config():
         config["photo_timelapse"]["enabled"] = bool(request.json["enabled"])
     
     if save_config(config):
-        return jsonify({
+        return json_response({
             "success": True, 
             "message": "Configuración de timelapse fotográfico actualizada",
             "config": config["photo_timelapse"]
         })
     else:
-        return jsonify({"success": False, "message": "Error al guardar la configuración"})
+        return json_response({"success": False, "message": "Error al guardar la configuración"})
 
-@app.teardown_appcontext
-def shutdown_session(exception=None):
+# Se registra con atexit: teardown_appcontext se ejecuta al final de cada petición,
+# no al cerrar la aplicación, y detenía la vista previa y cerraba la cámara cada vez
+@atexit.register
+def shutdown_session():
     """Limpia los recursos al cerrar la aplicación"""
-    global camera, stop_preview_event, stop_log_thread, stop_photo_timelapse
+    global stop_preview_event, stop_photo_timelapse
     
     stop_preview_event.set()
-    stop_log_thread.set()
     stop_photo_timelapse.set()
-    
-    with camera_lock:
-        if camera:
-            try:
-                camera.stop()
-                camera.close()
-                camera = None
-            except:
-                pass
+    # El time-lapse corre en un hilo daemon: pararlo para que escriba las imágenes
+    # pendientes y cierre su cámara antes de que termine el proceso
+    stop_timelapse()
+    close_camera()
+
+def _handle_sigterm(signum, frame):
+    """Convierte SIGTERM (systemd) en una salida normal para que se ejecuten los atexit"""
+    logger.info(f"Señal {signum} recibida, deteniendo la aplicación")
+    sys.exit(0)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True, threaded=True) 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Interfaz web de TimeLapse para Raspberry Pi")
+    parser.add_argument("--debug", action="store_true",
+                        help="Usar el servidor de desarrollo de Flask con el depurador activado")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Hilos de waitress; cada cliente de /video_feed ocupa uno mientras está conectado")
+    parser.add_argument("--accel-redirect", metavar="PREFIX",
+                        help="Delegar el envío de las imágenes a nginx mediante X-Accel-Redirect "
+                             "(location interna PREFIX que apunta a base_folder)")
+    args = parser.parse_args()
+    app.config["ACCEL_REDIRECT_PREFIX"] = args.accel_redirect
+    # El time-lapse se ejecuta en este proceso y escribe en timelapse.log
+    setup_timelapse_logging()
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    
+    if args.debug:
+        # Sin recargador: volvería a importar el módulo y a abrir la cámara en otro proceso
+        app.run(host='0.0.0.0', port=8080, debug=True, threaded=True, use_reloader=False)
+    else:
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=8080, threads=args.threads) 
\ No newline at end of file